@@ -1,10 +1,37 @@
-import base64
+import asyncio
 import glob
+import hashlib
+import io
 import os
+import re
+import shutil
+import struct
 import sys
+import threading
 from pathlib import Path
 
-import requests
+import aiohttp
+
+from pdf_ocr import (
+    CACHE_DIR,
+    MAX_ATTEMPTS,
+    OCR_PROMPT,
+    RateLimiter,
+    build_ocr_body,
+    cache_hasher,
+    cache_path_for,
+    count_pages,
+    encode_image,
+    hash_image,
+    is_retryable_error,
+    non_negative_int,
+    positive_float,
+    post_ocr_request,
+    render_pages,
+    sleep_before_retry,
+    with_index,
+    write_output,
+)
 
 # 利用可能なVisionモデル
 VISION_MODELS = {
@@ -21,108 +48,637 @@ VISION_MODELS = {
     "claude-3.5-sonnet": "anthropic/claude-3.5-sonnet",
 }
 
+# --tierで使うモデル（autoはfastで処理し、結果が不十分な画像だけbestで再実行する）
+FAST_TIER_MODEL = "gemma-12b-free"
+BEST_TIER_MODEL = "qwen-72b-free"
+
+# autoで上位モデルに再実行する判定の閾値
+UPGRADE_MIN_CHARS = 20  # 空白を除いた文字数がこれ未満
+UPGRADE_MAX_REPLACEMENT_CHARS = 5  # 文字化け (U+FFFD) がこれより多い
+REFUSAL_MARKERS = ("I cannot", "I can't", "I'm sorry", "I am unable", "申し訳")
+
+# 複数画像を処理する際の同時リクエスト数
+OCR_CONCURRENCY = max(1, int(os.environ.get("OCR_CONCURRENCY", 8)))
+
+# 1秒あたりの最大リクエスト数の既定値（無料モデルはクォータが厳しい）
+FREE_MODEL_RPS = 2.0
+PAID_MODEL_RPS = 10.0
+
+# OCR対象とする画像の拡張子（小文字、ドットなし）とMIMEタイプ
+IMAGE_MIME_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "gif": "image/gif",
+    "webp": "image/webp",
+    "bmp": "image/bmp",
+}
+
+# OCRに送る画像の長辺の最大ピクセル数（モデル側で縮小される分は送らない）
+MAX_IMAGE_EDGE = 1600
+
+# これより大きいファイルは--dedup-largeを指定しない限り内容の重複チェックをしない
+DEDUP_MAX_SIZE = 100 * 1024 * 1024
+
+# 入力に含まれるPDFのページを描画する解像度とJPEG品質
+PDF_DPI = 200
+PDF_JPEG_QUALITY = 85
+
+# PyMuPDFはスレッドセーフではないため、スレッドから使う処理は同時に1つだけ実行する
+FITZ_LOCK = threading.Lock()
+
+# PDFのページを画像と同じように扱うための名前 ("資料.pdf#p3" = 3ページ目)
+PAGE_REF_RE = re.compile(r"(.+\.pdf)#p(\d+)", re.IGNORECASE)
+
+
+def read_jpeg_size(f):
+    """JPEGのSOFマーカーから (幅, 高さ) を読む（見つからなければNone）"""
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xFF:  # 詰め物の0xFFは読み飛ばす
+            f.seek(-1, 1)
+            continue
+        if code == 0x01 or 0xD0 <= code <= 0xD8:  # 長さを持たないマーカー
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            sof = f.read(5)
+            if len(sof) < 5:
+                return None
+            _, height, width = struct.unpack(">BHH", sof)
+            return width, height
+        f.seek(struct.unpack(">H", length)[0] - 2, 1)
+
+
+def read_image_size(image_path):
+    """画像全体をデコードせずヘッダーから (幅, 高さ) を読む（未対応の形式ならNone）"""
+    with open(image_path, "rb") as f:
+        head = f.read(32)
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and len(head) >= 24:
+            return struct.unpack(">II", head[16:24])
+        if head[:6] in (b"GIF87a", b"GIF89a") and len(head) >= 10:
+            return struct.unpack("<HH", head[6:10])
+        if head.startswith(b"BM") and len(head) >= 26:
+            width, height = struct.unpack("<ii", head[18:26])
+            return width, abs(height)  # 高さが負ならトップダウン形式
+        if head.startswith(b"RIFF") and head[8:12] == b"WEBP" and len(head) >= 30:
+            chunk = head[12:16]
+            if chunk == b"VP8X":
+                width = int.from_bytes(head[24:27], "little") + 1
+                height = int.from_bytes(head[27:30], "little") + 1
+                return width, height
+            if chunk == b"VP8L":
+                bits = int.from_bytes(head[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", head[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            return None
+        if head.startswith(b"\xff\xd8"):
+            return read_jpeg_size(f)
+    return None
+
+
+def downscale_image(image_path, max_edge, jpeg_quality=85):
+    """長辺がmax_edgeを超える画像を縮小してJPEGのbytesを返す（縮小不要ならNone）"""
+    # サイズはヘッダーから読み、縮小しない画像はデコードしない
+    size = read_image_size(image_path)
+    if size is None or max(size) <= max_edge:
+        return None  # 読めない形式や小さい画像は縮小せずそのまま送る
+    import fitz  # PyMuPDF
+
+    # Pixmapで直接読むとEXIFのOrientationが無視されたうえ再エンコードで失われるため、
+    # 文書として開いて描画する（向きを適用済みのページになる。アルファは白背景に合成）
+    try:
+        with fitz.open(image_path) as doc:
+            rect = doc[0].rect
+            zoom = max_edge / max(rect.width, rect.height)
+            pix = doc[0].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    except Exception:
+        return None
+    return pix.tobytes("jpeg", jpg_quality=jpeg_quality)
+
+
+def page_ref(pdf_path, page_num):
+    """PDFのページ (0始まり) を表す名前"""
+    return f"{pdf_path}#p{page_num + 1}"
+
+
+def split_page_ref(image_path):
+    """PDFのページを表す名前なら (PDFのパス, ページ番号 (0始まり)) を返す（画像ならNone）"""
+    m = PAGE_REF_RE.fullmatch(image_path)
+    if m is None:
+        return None
+    return m.group(1), int(m.group(2)) - 1
+
+
+def open_image(image_path, max_edge):
+    """画像を開いて (ファイルオブジェクト, MIMEタイプ) を返す
+
+    長辺がmax_edgeを超える画像は縮小したJPEGをメモリ上のファイルとして返す
+    PDFのページはディスクに書き出さずメモリ上でJPEGに描画して返す
+    （同時実行枠を取ってからスレッドで呼ばれ、PDFはopen_pdfのキャッシュで開き直さない）
+    """
+    page = split_page_ref(image_path)
+    if page is not None:
+        pdf_path, page_num = page
+        # min_text_chars=0でテキスト層の有無にかかわらず描画する
+        with FITZ_LOCK:
+            [(_, data)] = render_pages(
+                pdf_path,
+                [page_num],
+                PDF_DPI,
+                "jpeg",
+                PDF_JPEG_QUALITY,
+                max_edge,
+                False,
+                0,
+            )
+        return io.BytesIO(data), "image/jpeg"
+
+    if max_edge:
+        with FITZ_LOCK:
+            resized = downscale_image(image_path, max_edge)
+        if resized is not None:
+            return io.BytesIO(resized), "image/jpeg"
+    return open(image_path, "rb"), get_image_mime_type(image_path)
+
+
+def load_image(image_path, max_edge, hashers, encode=True):
+    """画像を開き、hashersに入力しながらencodeならdata URIにも変換する（スレッドで実行）
+
+    戻り値は (ファイルオブジェクト, MIMEタイプ, data URIまたはNone)。ファイルは呼び出し側で閉じる
+    """
+    image_file, mime_type = open_image(image_path, max_edge)
+    try:
+        if encode:
+            return image_file, mime_type, encode_image(image_file, mime_type, *hashers)
+        hash_image(image_file, *hashers)
+        return image_file, mime_type, None
+    except BaseException:
+        image_file.close()
+        raise
+
+
+def upload_url_for(upload_url, image_hasher, mime_type):
+    """画像の内容のハッシュから決まるアップロード先のURL"""
+    return (
+        f"{upload_url.rstrip('/')}/{image_hasher.hexdigest()}.{mime_type.split('/')[1]}"
+    )
+
+
+async def upload_image(session, limiter, image_file, mime_type, url, name=None):
+    """画像をBase64にせずそのままurlへPUTする（成功したらTrue）
+
+    OCRリクエストと同じくレート制限に従い、429/5xxは指数バックオフでリトライする
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        retry_after = None
+        try:
+            await limiter.acquire()
+            image_file.seek(0)
+            # ファイルオブジェクトを渡すとメモリに読み込まずに送信される
+            async with session.put(
+                url, data=image_file, headers={"Content-Type": mime_type}
+            ) as response:
+                if response.status < 400:
+                    return True
+                error_msg = await response.text()
+                retry_after = response.headers.get("Retry-After")
+
+            print(f"アップロードエラー ({name}): {response.status}")
+            print(f"詳細: {error_msg}")
+            if not is_retryable_error(response.status, error_msg):
+                return False
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"アップロードエラー ({name}): {e}")
+
+        if attempt < MAX_ATTEMPTS:
+            await sleep_before_retry(attempt, retry_after, name)
+
+    return False
+
 
-def encode_image(image_path):
-    """画像をBase64エンコード"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+def group_identical_images(image_files, dedup_large=False):
+    """内容が同一の画像ごとにインデックスをまとめる（各グループの先頭が代表）"""
+    groups = {}
+    for index, image_path in enumerate(image_files):
+        key = image_path
+        if split_page_ref(image_path) is not None:
+            pass  # PDFのページは描画しないと比較できないので個別に扱う
+        else:
+            try:
+                # 大きなファイルはハッシュ計算せず個別に扱う
+                if dedup_large or os.path.getsize(image_path) <= DEDUP_MAX_SIZE:
+                    hasher = hashlib.blake2b(digest_size=16)
+                    with open(image_path, "rb") as image_file:
+                        hash_image(image_file, hasher)
+                    key = hasher.digest()
+            except OSError:
+                pass  # 読めないファイルは個別に扱い、OCR時にその画像の失敗として報告する
+        groups.setdefault(key, []).append(index)
+    return list(groups.values())
+
+
+def iter_image_files(patterns):
+    """ディレクトリ・パターン・ファイルから画像ファイルとPDFのパスを重複なく列挙"""
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            # ディレクトリの場合、直下のすべての画像を1回の走査で取得
+            with os.scandir(pattern) as entries:
+                paths = [
+                    entry.path
+                    for entry in entries
+                    if not entry.name.startswith(".") and entry.is_file()
+                ]
+        else:
+            # パターンに一致した画像名のディレクトリなどは含めない
+            paths = (path for path in glob.iglob(pattern) if os.path.isfile(path))
+
+        for path in paths:
+            ext = path.rpartition(".")[2].lower()
+            if ext in IMAGE_MIME_TYPES or ext == "pdf":
+                if path not in seen:
+                    seen.add(path)
+                    yield path
+
+
+def expand_pdf_pages(paths):
+    """PDFをページごとの名前に展開し、画像はそのまま返す"""
+    for path in paths:
+        if path.rpartition(".")[2].lower() != "pdf":
+            yield path
+            continue
+        num_pages = count_pages(path)
+        if num_pages is None:
+            continue  # 読み込めないPDFはスキップ（エラーはcount_pagesが表示）
+        for page_num in range(num_pages):
+            yield page_ref(path, page_num)
+
+
+def output_stem(image_path):
+    """出力ファイル名の元になる名前（PDFのページは "資料_p3"）"""
+    page = split_page_ref(image_path)
+    if page is not None:
+        pdf_path, page_num = page
+        return f"{Path(pdf_path).stem}_p{page_num + 1}"
+    return Path(image_path).stem
 
 
 def get_image_mime_type(image_path):
     """ファイル拡張子からMIMEタイプを取得"""
-    ext = Path(image_path).suffix.lower()
-    mime_types = {
-        ".png": "image/png",
-        ".jpg": "image/jpeg",
-        ".jpeg": "image/jpeg",
-        ".gif": "image/gif",
-        ".webp": "image/webp",
-        ".bmp": "image/bmp",
-    }
-    return mime_types.get(ext, "image/png")
-
-
-def ocr_with_openrouter(image_path, model, api_key, custom_prompt=None):
-    """OpenRouterを使ってOCR実行"""
+    return IMAGE_MIME_TYPES.get(image_path.rpartition(".")[2].lower(), "image/png")
+
+
+async def ocr_with_openrouter_async(
+    session,
+    image_path,
+    model,
+    api_key,
+    semaphore,
+    limiter,
+    custom_prompt=None,
+    cache_dir=None,
+    upload_url=None,
+    max_edge=MAX_IMAGE_EDGE,
+    output_file=None,
+    uploaded_urls=None,
+):
+    """OpenRouterを使ってOCR実行（429/5xxは指数バックオフでリトライ）
+
+    cache_dirを指定すると同じ画像・モデル・プロンプトの結果をキャッシュから返す
+    upload_urlを指定すると画像をそこへアップロードし、data URIの代わりにURLで渡す
+    （uploaded_urlsにあるURLはこの実行でアップロード済みとして再送しない）
+    長辺がmax_edgeを超える画像は縮小してから送る（0なら縮小しない）
+    output_fileを指定すると結果をストリーミングで受信しながらそのファイルに保存する
+
+    画像の読み込み・縮小・エンコードは同時実行数の枠を取ってから行うので、
+    メモリ上にある画像とリクエストボディは同時実行数分だけになる
+    """
+    # 並列実行中のどの画像のメッセージか分かるようにする
+    name = Path(image_path).name
     try:
-        base64_image = encode_image(image_path)
-        mime_type = get_image_mime_type(image_path)
-
         # デフォルトのプロンプト
         if custom_prompt is None:
-            custom_prompt = """この画像からテキストを正確に抽出してください。
-
-要件:
-- レイアウト、表、箇条書きなどの構造を保持
-- 出力はマークダウン形式
-- 余計な説明は不要、テキストのみを出力
-- 日本語の場合は日本語で、英語の場合は英語で出力"""
-
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "HTTP-Referer": "https://github.com/pdf-converter",
-                "X-Title": "Image OCR Tool",
-            },
-            json={
-                "model": model,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": custom_prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:{mime_type};base64,{base64_image}"
-                                },
-                            },
-                        ],
-                    }
-                ],
-                "max_tokens": 4000,
-                "temperature": 0.1,
-            },
-            timeout=120,
-        )
-
-        if response.status_code == 200:
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        else:
-            error_msg = response.json().get("error", {})
-            print(f"OpenRouter APIエラー: {response.status_code}")
-            print(f"詳細: {error_msg}")
-            return None
+            custom_prompt = OCR_PROMPT
+
+        async with semaphore:
+            # キャッシュキーのハッシュ計算とBase64エンコードを1回の読み込みで行う
+            # （デコード・エンコードで受信中の他のストリームを止めないようスレッドで実行）
+            hasher = cache_hasher(model, custom_prompt)
+            # アップロード先の名前は画像の内容だけから決める（モデル・プロンプトを含めない）
+            image_hasher = hashlib.blake2b(digest_size=20)
+            image_file, mime_type, data_uri = await asyncio.to_thread(
+                load_image,
+                image_path,
+                max_edge,
+                (hasher, image_hasher) if upload_url else (hasher,),
+                not upload_url,
+            )
+            with image_file:
+                cache_path = None
+                if cache_dir:
+                    cache_path = cache_path_for(cache_dir, hasher)
+                    if cache_path.exists():
+                        text = cache_path.read_text(encoding="utf-8")
+                        if output_file:
+                            write_output(output_file, text)
+                        return text
+
+                if upload_url:
+                    # アップロード先は画像の内容から決まるので、同じ画像は
+                    # モデルが違っても同じURLになり、この実行で送信済みなら再送しない
+                    image_url = upload_url_for(upload_url, image_hasher, mime_type)
+                    if uploaded_urls is None or image_url not in uploaded_urls:
+                        if not await upload_image(
+                            session, limiter, image_file, mime_type, image_url, name
+                        ):
+                            return None
+                        if uploaded_urls is not None:
+                            uploaded_urls.add(image_url)
+
+            if upload_url:
+                request_body = build_ocr_body(image_url, model, custom_prompt)
+            else:
+                # Base64はstrに戻さずリクエストボディに直接埋め込み、リトライ前に一度だけ組み立てる
+                request_body = build_ocr_body(data_uri, model, custom_prompt)
+                del data_uri
+
+            return await post_ocr_request(
+                session,
+                request_body,
+                api_key,
+                limiter,
+                title="Image OCR Tool",
+                cache_path=cache_path,
+                output_file=output_file,
+                name=name,
+            )
 
-    except requests.exceptions.RequestException as e:
-        print(f"リクエストエラー: {e}")
-        return None
     except Exception as e:
-        print(f"OCRエラー: {e}")
+        print(f"OCRエラー ({name}): {e}")
         return None
 
 
-def process_single_image(
-    image_path, model, api_key, output_file=None, custom_prompt=None
+def needs_upgrade(text):
+    """OCR結果が不十分で上位モデルで再実行すべきか（空・短すぎる・文字化け・拒否応答）"""
+    return (
+        not text
+        or len(text.strip()) < UPGRADE_MIN_CHARS
+        or text.count("\ufffd") > UPGRADE_MAX_REPLACEMENT_CHARS
+        or any(marker in text[:100] for marker in REFUSAL_MARKERS)
+    )
+
+
+async def ocr_with_upgrade_async(
+    session,
+    image_path,
+    model,
+    upgrade_model,
+    api_key,
+    semaphore,
+    limiter,
+    custom_prompt=None,
+    cache_dir=None,
+    upload_url=None,
+    max_edge=MAX_IMAGE_EDGE,
+    output_file=None,
+    upgraded=None,
+    uploaded_urls=None,
 ):
-    """単一画像をOCR処理"""
-    print(f"\n画像を処理中: {image_path}")
-    print(f"モデル: {model}\n")
+    """modelでOCRし、結果が不十分ならupgrade_modelで再実行する
 
-    text = ocr_with_openrouter(image_path, model, api_key, custom_prompt)
+    再実行した画像はupgradedに追加する。再実行にも失敗した場合は最初の結果を返す
+    """
+    args = (custom_prompt, cache_dir, upload_url, max_edge, output_file, uploaded_urls)
+    text = await ocr_with_openrouter_async(
+        session, image_path, model, api_key, semaphore, limiter, *args
+    )
+    if not needs_upgrade(text):
+        return text
+
+    print(f"  {Path(image_path).name}: 結果が不十分なため上位モデルで再実行")
+    if upgraded is not None:
+        upgraded.append(image_path)
+    upgraded_text = await ocr_with_openrouter_async(
+        session, image_path, upgrade_model, api_key, semaphore, limiter, *args
+    )
+    return upgraded_text or text
+
+
+async def ocr_images(
+    image_files,
+    model,
+    api_key,
+    custom_prompt=None,
+    rps=FREE_MODEL_RPS,
+    cache_dir=CACHE_DIR,
+    upload_url=None,
+    max_edge=MAX_IMAGE_EDGE,
+    output_files=None,
+    upgrade_model=None,
+    upgraded=None,
+):
+    """複数画像のOCRを並列実行し、完了した順に (インデックス, テキスト) をyieldする
+
+    output_filesを指定すると各画像の結果をそれぞれのファイルに保存する
+    upgrade_modelを指定すると結果が不十分な画像をそのモデルで再実行し、upgradedに追加する
+    """
+    if output_files is None:
+        output_files = [None] * len(image_files)
+    semaphore = asyncio.Semaphore(OCR_CONCURRENCY)
+    limiter = RateLimiter(rps)
+    uploaded_urls = set()  # --upload-urlでこの実行中にアップロード済みのURL
+    # 同時実行数ぶんのHTTPS接続をキープアライブで使い回し、TLSハンドシェイクを省く
+    connector = aiohttp.TCPConnector(limit=OCR_CONCURRENCY, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=aiohttp.ClientTimeout(total=120)
+    ) as session:
+        tasks = [
+            asyncio.create_task(
+                with_index(
+                    index,
+                    (
+                        ocr_with_upgrade_async(
+                            session,
+                            image_path,
+                            model,
+                            upgrade_model,
+                            api_key,
+                            semaphore,
+                            limiter,
+                            custom_prompt,
+                            cache_dir,
+                            upload_url,
+                            max_edge,
+                            output_file,
+                            upgraded,
+                            uploaded_urls,
+                        )
+                        if upgrade_model
+                        else ocr_with_openrouter_async(
+                            session,
+                            image_path,
+                            model,
+                            api_key,
+                            semaphore,
+                            limiter,
+                            custom_prompt,
+                            cache_dir,
+                            upload_url,
+                            max_edge,
+                            output_file,
+                            uploaded_urls,
+                        )
+                    ),
+                ),
+                name=image_path,
+            )
+            for index, (image_path, output_file) in enumerate(
+                zip(image_files, output_files)
+            )
+        ]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            # Ctrl-Cなどで中断された場合は実行中のリクエストを取り消してから接続を閉じる
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def collect_texts(results, count):
+    """ocr_imagesの結果を画像順のリストにまとめる"""
+    texts = [None] * count
+    async for index, text in results:
+        texts[index] = text
+    return texts
+
+
+def write_combined_entry(combined_file, image_path, text):
+    """結合ファイルに1画像分のテキストを追記"""
+    combined_file.write(f"=== {Path(image_path).name} ===\n\n")
+    combined_file.write(text)
+    combined_file.write(f"\n\n{'=' * 50}\n\n")
+    combined_file.flush()
+
+
+async def write_results(results, groups, image_files, output_files, combined_file):
+    """完了した画像から順に結果を表示し、結合ファイルには画像順に追記する
+
+    resultsはgroupsの代表画像ごとの結果で、同じ内容の画像には代表の結果をコピーする
+    戻り値は画像順の成否のリスト
+    """
+    successes = [False] * len(image_files)
+    pending = {}
+    next_index = 0
+    done = 0
+    async for group_index, text in results:
+        done += 1
+        indices = groups[group_index]
+        first = indices[0]
+        name = Path(image_files[first]).name
+        if text:
+            print(f"[{done}/{len(groups)}] ✓ {name} -> {output_files[first]}")
+            for index in indices[1:]:
+                if output_files[index] != output_files[first]:
+                    shutil.copyfile(output_files[first], output_files[index])
+                print(
+                    f"    同じ内容: {Path(image_files[index]).name} -> {output_files[index]}"
+                )
+            for index in indices:
+                successes[index] = True
+        else:
+            print(f"[{done}/{len(groups)}] ✗ {name} 失敗")
+
+        # 前の画像まで揃った分だけ書き出し、未完了の画像より後の結果だけを保持する
+        for index in indices:
+            pending[index] = text
+        while next_index in pending:
+            text = pending.pop(next_index)
+            if text:
+                write_combined_entry(combined_file, image_files[next_index], text)
+            next_index += 1
+    return successes
+
+
+def ocr_with_openrouter(
+    image_path,
+    model,
+    api_key,
+    custom_prompt=None,
+    rps=FREE_MODEL_RPS,
+    cache_dir=CACHE_DIR,
+    upload_url=None,
+    max_edge=MAX_IMAGE_EDGE,
+    output_file=None,
+    upgrade_model=None,
+    upgraded=None,
+):
+    """OpenRouterを使ってOCR実行（単一画像用の同期ラッパー）"""
+    results = ocr_images(
+        [image_path],
+        model,
+        api_key,
+        custom_prompt,
+        rps=rps,
+        cache_dir=cache_dir,
+        upload_url=upload_url,
+        max_edge=max_edge,
+        output_files=[output_file],
+        upgrade_model=upgrade_model,
+        upgraded=upgraded,
+    )
+    return asyncio.run(collect_texts(results, 1))[0]
 
-    if text:
-        # 出力ファイル名を決定
-        if output_file is None:
-            base_name = Path(image_path).stem
-            output_file = f"{base_name}_ocr.txt"
 
-        # テキストファイルに保存
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(text)
+def process_single_image(
+    image_path,
+    model,
+    api_key,
+    output_file=None,
+    custom_prompt=None,
+    rps=FREE_MODEL_RPS,
+    cache_dir=CACHE_DIR,
+    upload_url=None,
+    max_edge=MAX_IMAGE_EDGE,
+    upgrade_model=None,
+):
+    """単一画像をOCR処理（upgrade_modelを指定すると結果が不十分な場合に再実行）"""
+    print(f"\n画像を処理中: {image_path}")
+    print(f"モデル: {model}")
+    if upgrade_model:
+        print(f"上位モデル: {upgrade_model}")
+    print()
+
+    # 出力ファイル名を決定
+    if output_file is None:
+        base_name = output_stem(image_path)
+        output_file = f"{base_name}_ocr.txt"
+
+    # 受信しながらテキストファイルに保存
+    text = ocr_with_openrouter(
+        image_path,
+        model,
+        api_key,
+        custom_prompt,
+        rps,
+        cache_dir,
+        upload_url,
+        max_edge,
+        output_file,
+        upgrade_model,
+    )
 
+    if text:
         print(f"\n✓ OCR成功!")
         print(f"出力ファイル: {output_file}")
         print(f"\n--- 抽出されたテキスト (最初の500文字) ---")
@@ -136,27 +692,25 @@ def process_single_image(
 
 
 def process_multiple_images(
-    image_patterns, model, api_key, output_dir=None, custom_prompt=None
+    image_patterns,
+    model,
+    api_key,
+    output_dir=None,
+    custom_prompt=None,
+    rps=FREE_MODEL_RPS,
+    cache_dir=CACHE_DIR,
+    upload_url=None,
+    max_edge=MAX_IMAGE_EDGE,
+    dedup_large=False,
+    upgrade_model=None,
 ):
-    """複数画像をOCR処理"""
-    # パターンから画像ファイルを取得
-    image_files = []
-    for pattern in image_patterns:
-        if os.path.isdir(pattern):
-            # ディレクトリの場合、すべての画像を取得
-            pattern = os.path.join(pattern, "*")
-
-        files = glob.glob(pattern)
-        image_files.extend(
-            [
-                f
-                for f in files
-                if Path(f).suffix.lower()
-                in [".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp"]
-            ]
-        )
+    """複数画像をOCR処理（内容が同一の画像は1回だけOCRする）
 
-    image_files = sorted(list(set(image_files)))  # 重複削除とソート
+    PDFは各ページをメモリ上で画像に描画して同じようにOCRする
+    upgrade_modelを指定すると結果が不十分な画像だけそのモデルで再実行する
+    """
+    # パターンから画像ファイルを取得（重複削除とソート、PDFはページ順に展開）
+    image_files = list(expand_pdf_pages(sorted(iter_image_files(image_patterns))))
 
     if not image_files:
         print("エラー: 画像ファイルが見つかりません")
@@ -170,49 +724,58 @@ def process_multiple_images(
     print(f"\n=== 画像OCR処理 ===")
     print(f"画像数: {len(image_files)}")
     print(f"モデル: {model}")
-    print(f"出力先: {output_dir}/\n")
-
-    results = []
-    for i, image_path in enumerate(image_files, 1):
-        print(f"--- [{i}/{len(image_files)}] {Path(image_path).name} ---")
-
-        output_file = os.path.join(output_dir, f"{Path(image_path).stem}_ocr.txt")
-        text = ocr_with_openrouter(image_path, model, api_key, custom_prompt)
+    if upgrade_model:
+        print(f"上位モデル: {upgrade_model}")
+    print(f"出力先: {output_dir}/")
+    print(f"同時実行数: {OCR_CONCURRENCY} (最大 {rps} リクエスト/秒)")
+
+    groups = group_identical_images(image_files, dedup_large)
+    if len(groups) < len(image_files):
+        print(f"重複: {len(image_files) - len(groups)} 枚は同じ内容の画像の結果を使用")
+    print()
+
+    output_files = [
+        os.path.join(output_dir, f"{output_stem(image_path)}_ocr.txt")
+        for image_path in image_files
+    ]
+
+    # 内容ごとに1枚ずつ並列にOCRし、受信しながら各ファイルに保存
+    upgraded = []
+    results = ocr_images(
+        [image_files[group[0]] for group in groups],
+        model,
+        api_key,
+        custom_prompt,
+        rps=rps,
+        cache_dir=cache_dir,
+        upload_url=upload_url,
+        max_edge=max_edge,
+        output_files=[output_files[group[0]] for group in groups],
+        upgrade_model=upgrade_model,
+        upgraded=upgraded,
+    )
 
-        if text:
-            with open(output_file, "w", encoding="utf-8") as f:
-                f.write(text)
-            results.append(
-                {
-                    "image": image_path,
-                    "output": output_file,
-                    "text": text,
-                    "success": True,
-                }
-            )
-            print(f"✓ 成功: {output_file}")
-        else:
-            results.append({"image": image_path, "success": False})
-            print(f"✗ 失敗")
-        print()
+    # すべてのテキストを結合したファイルも完了したものから作成
+    combined_file = os.path.join(output_dir, "all_combined.txt")
+    with open(combined_file, "w", encoding="utf-8") as f:
+        successes = asyncio.run(
+            write_results(results, groups, image_files, output_files, f)
+        )
 
     # サマリー
-    success_count = sum(1 for r in results if r["success"])
+    success_count = sum(successes)
     print(f"\n=== 処理完了 ===")
-    print(f"成功: {success_count}/{len(results)}")
+    print(f"成功: {success_count}/{len(image_files)}")
+    if upgrade_model:
+        # 閾値の調整用に上位モデルで再実行した割合を表示する
+        print(
+            f"上位モデルで再実行: {len(upgraded)}/{len(groups)}"
+            f" ({len(upgraded) / len(groups):.0%})"
+        )
     print(f"出力ディレクトリ: {output_dir}/")
-
-    # すべてのテキストを結合したファイルも作成
-    combined_file = os.path.join(output_dir, "all_combined.txt")
-    with open(combined_file, "w", encoding="utf-8") as f:
-        for i, result in enumerate(results, 1):
-            if result["success"]:
-                f.write(f"=== {Path(result['image']).name} ===\n\n")
-                f.write(result["text"])
-                f.write(f"\n\n{'=' * 50}\n\n")
     print(f"結合ファイル: {combined_file}")
 
-    return success_count == len(results)
+    return success_count == len(image_files)
 
 
 def main():
@@ -235,18 +798,27 @@ def main():
   # ディレクトリ内のすべての画像
   python image_ocr.py document_images/
 
+  # PDFもページごとに画像と同じようにOCR（ページ画像をディスクに書き出さない）
+  python image_ocr.py document.pdf scans/
+
   # モデルを指定
   python image_ocr.py image.png --model qwen-72b-free
 
+  # 軽量モデルで処理し、結果が不十分な画像だけ上位モデルで再実行
+  python image_ocr.py document_images/ --tier auto
+
   # 出力先を指定
   python image_ocr.py image.png -o result.txt
 
   # カスタムプロンプト
   python image_ocr.py receipt.png --prompt "この領収書から金額と日付を抽出してください"
+
+  # 画像をアップロードしてURLで渡す（Base64エンコードしない）
+  python image_ocr.py document_images/ --upload-url https://storage.example.com/ocr
 """,
     )
     parser.add_argument(
-        "images", nargs="+", help="画像ファイル、ディレクトリ、またはパターン"
+        "images", nargs="+", help="画像ファイル、PDF、ディレクトリ、またはパターン"
     )
     parser.add_argument("-o", "--output", help="出力ファイル名（単一画像の場合）")
     parser.add_argument(
@@ -259,8 +831,43 @@ def main():
         choices=list(VISION_MODELS.keys()),
         help="使用するモデル (デフォルト: qwen-72b-free)",
     )
+    parser.add_argument(
+        "--tier",
+        choices=["auto", "fast", "best"],
+        help=f"--modelの代わりに使うモデルの段階。fast: {FAST_TIER_MODEL}, best: {BEST_TIER_MODEL}, "
+        "auto: fastで処理し、結果が空・短すぎる・文字化け・拒否応答の画像だけbestで再実行",
+    )
     parser.add_argument("--api-key", help="OpenRouter APIキー")
     parser.add_argument("--prompt", help="カスタムプロンプト")
+    parser.add_argument(
+        "--rps",
+        type=positive_float,
+        help=f"1秒あたりの最大リクエスト数 (デフォルト: 無料モデル {FREE_MODEL_RPS}, 有料モデル {PAID_MODEL_RPS})",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="OCR結果のキャッシュを使わない"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=CACHE_DIR,
+        help=f"OCR結果のキャッシュ先 (デフォルト: {CACHE_DIR})",
+    )
+    parser.add_argument(
+        "--max-image-edge",
+        type=non_negative_int,
+        default=MAX_IMAGE_EDGE,
+        help=f"OCRに送る画像の長辺の最大ピクセル数、超える画像はJPEGに縮小して送る。0で縮小しない (デフォルト: {MAX_IMAGE_EDGE})",
+    )
+    parser.add_argument(
+        "--dedup-large",
+        action="store_true",
+        help=f"{DEDUP_MAX_SIZE // 1024 // 1024}MBを超える画像も内容の重複をチェックする",
+    )
+    parser.add_argument(
+        "--upload-url",
+        help="画像をこのURL配下にPUTでアップロードし、Base64の代わりにURLでモデルに渡す"
+        "（モデル側から取得できるURLであること）",
+    )
     parser.add_argument(
         "--list-models", action="store_true", help="利用可能なモデルを表示"
     )
@@ -283,7 +890,25 @@ def main():
         print("2. python image_ocr.py image.png --api-key your-api-key")
         sys.exit(1)
 
-    model_full_name = VISION_MODELS[args.model]
+    model = args.model
+    upgrade_model = None
+    if args.tier == "fast":
+        model = FAST_TIER_MODEL
+    elif args.tier == "best":
+        model = BEST_TIER_MODEL
+    elif args.tier == "auto":
+        model, upgrade_model = FAST_TIER_MODEL, BEST_TIER_MODEL
+
+    model_full_name = VISION_MODELS[model]
+    upgrade_model_full_name = VISION_MODELS[upgrade_model] if upgrade_model else None
+    rps = args.rps
+    if rps is None:
+        rps = (
+            FREE_MODEL_RPS
+            if "free" in model or "free" in (upgrade_model or "")
+            else PAID_MODEL_RPS
+        )
+    cache_dir = None if args.no_cache else args.cache_dir
 
     # 画像ファイルのチェック
     all_images = []
@@ -295,17 +920,45 @@ def main():
             all_images.extend(args.images)
             break
 
-    # 単一画像か複数画像かで処理を分ける
-    if len(args.images) == 1 and os.path.isfile(args.images[0]):
-        # 単一画像
-        process_single_image(
-            args.images[0], model_full_name, api_key, args.output, args.prompt
-        )
-    else:
-        # 複数画像
-        process_multiple_images(
-            args.images, model_full_name, api_key, args.output_dir, args.prompt
-        )
+    try:
+        # 単一画像か複数画像かで処理を分ける
+        if (
+            len(args.images) == 1
+            and os.path.isfile(args.images[0])
+            and not args.images[0].lower().endswith(".pdf")
+        ):
+            # 単一画像
+            process_single_image(
+                args.images[0],
+                model_full_name,
+                api_key,
+                args.output,
+                args.prompt,
+                rps=rps,
+                cache_dir=cache_dir,
+                upload_url=args.upload_url,
+                max_edge=args.max_image_edge,
+                upgrade_model=upgrade_model_full_name,
+            )
+        else:
+            # 複数画像
+            process_multiple_images(
+                args.images,
+                model_full_name,
+                api_key,
+                args.output_dir,
+                args.prompt,
+                rps=rps,
+                cache_dir=cache_dir,
+                upload_url=args.upload_url,
+                max_edge=args.max_image_edge,
+                dedup_large=args.dedup_large,
+                upgrade_model=upgrade_model_full_name,
+            )
+    except KeyboardInterrupt:
+        # 実行中のリクエストはキャンセル済み、受信途中のファイルも削除済み
+        print("\n中断しました")
+        sys.exit(130)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,21 @@
+import io
+import logging
 import os
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
+from itertools import repeat
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+# テキスト抽出・一括変換の既定ワーカー数
+DEFAULT_WORKERS = min(os.cpu_count() or 1, 6)
+
+# 段落テキスト中でw:tではなく専用要素に置き換える文字（python-docxのrun.textと同じ）
+SPECIAL_CHARS_RE = re.compile(r"([\t\n\r])")
+
+PAGE_BREAK_XML = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
 
 
 def convert_with_pdf2docx(input_pdf, output_docx):
@@ -18,24 +34,97 @@ def convert_with_pdf2docx(input_pdf, output_docx):
         return False
 
 
-def convert_with_pymupdf(input_pdf, output_docx):
+def extract_page_texts(input_pdf, start, stop):
+    """start〜stop-1ページのテキストを抽出（ワーカープロセスで実行）"""
+    import fitz  # PyMuPDF
+
+    # fitz.Documentはプロセス間で共有できないため各ワーカーで開き直す
+    with fitz.open(input_pdf) as pdf:
+        return [pdf[i].get_text() for i in range(start, stop)]
+
+
+def extract_all_texts(input_pdf, num_pages, workers=DEFAULT_WORKERS):
+    """全ページのテキストを複数プロセスで並列に抽出（結果はページ順）
+
+    PyMuPDFはスレッドセーフではなくGILも解放しないため、スレッドではなくプロセスで分割する
+    """
+    if workers <= 1 or num_pages <= 1:
+        return extract_page_texts(input_pdf, 0, num_pages)
+
+    size = -(-num_pages // workers)  # 切り上げ
+    starts = range(0, num_pages, size)
+    stops = [min(start + size, num_pages) for start in starts]
+    with ProcessPoolExecutor(max_workers=len(starts)) as executor:
+        results = executor.map(extract_page_texts, repeat(input_pdf), starts, stops)
+        return [text for chunk in results for text in chunk]
+
+
+def paragraph_xml(text):
+    """1ページ分のテキストを表す段落 (w:p) のXML文字列
+
+    doc.add_paragraph(text) と同じく、改行はw:br、タブはw:tabにする
+    """
+    runs = []
+    for part in SPECIAL_CHARS_RE.split(text):
+        if part == "\t":
+            runs.append("<w:tab/>")
+        elif part in ("\n", "\r"):
+            runs.append("<w:br/>")
+        elif part:
+            runs.append(f'<w:t xml:space="preserve">{escape(part)}</w:t>')
+    return f"<w:p><w:r>{''.join(runs)}</w:r></w:p>"
+
+
+def add_pages(doc, texts):
+    """各ページを段落+改ページとして追加
+
+    python-docxのadd_paragraph/add_page_breakは1回ごとにオブジェクトを介してXMLを
+    組み立てて遅いため、全ページ分のXMLを一度にパースして本文にまとめて挿入する
+    """
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+
+    xml = "".join(
+        paragraph_xml(text) + PAGE_BREAK_XML
+        for text in texts
+        if text.strip()  # 空白ページをスキップ
+    )
+    body = doc.element.body
+    # セクション設定 (w:sectPr) は本文の最後に置く必要があるのでその手前に挿入する
+    index = body.index(body.sectPr) if body.sectPr is not None else len(body)
+    body[index:index] = list(parse_xml(f'<w:body {nsdecls("w")}>{xml}</w:body>'))
+
+
+def add_pages_safe(doc, texts):
+    """python-docxのAPIだけで各ページを追加（--safe-docx用の低速版）"""
+    for text in texts:
+        if text.strip():  # 空白ページをスキップ
+            doc.add_paragraph(text)
+            doc.add_page_break()
+
+
+def convert_with_pymupdf(
+    input_pdf, output_docx, workers=DEFAULT_WORKERS, safe_docx=False
+):
     """PyMuPDFを使った変換（制限を無視できる）"""
     try:
         import fitz  # PyMuPDF
         from docx import Document
 
         print(f"PyMuPDFで変換中: {input_pdf} -> {output_docx}")
-        doc = Document()
-        pdf = fitz.open(input_pdf)
+        with fitz.open(input_pdf) as pdf:
+            num_pages = len(pdf)
+
+        print(f"  {num_pages} ページのテキストを抽出中...")
+        texts = extract_all_texts(input_pdf, num_pages, workers)
 
-        for page_num, page in enumerate(pdf, 1):
-            print(f"  ページ {page_num}/{len(pdf)} 処理中...")
-            text = page.get_text()
-            if text.strip():  # 空白ページをスキップ
-                doc.add_paragraph(text)
-                doc.add_page_break()
+        # python-docxはスレッドセーフではないので文書の組み立てはメインプロセスで行う
+        doc = Document()
+        if safe_docx:
+            add_pages_safe(doc, texts)
+        else:
+            add_pages(doc, texts)
 
-        pdf.close()
         doc.save(output_docx)
         print("✓ 変換成功!")
         return True
@@ -66,20 +155,125 @@ def unlock_pdf(input_pdf, output_pdf):
         return False
 
 
+def convert_pdf(input_pdf, output_docx, workers=DEFAULT_WORKERS, safe_docx=False):
+    """変換方法を順に試してPDFをWordに変換（成功したらTrue）"""
+    # まずpdf2docxを試す（レイアウトが綺麗）
+    if convert_with_pdf2docx(input_pdf, output_docx):
+        return True
+
+    # 失敗したらPyMuPDFを試す（制限に強い）
+    print("\n別の方法を試します...")
+    if convert_with_pymupdf(input_pdf, output_docx, workers, safe_docx):
+        return True
+
+    # それでも失敗したら制限解除を試みる
+    print("\nPDF制限解除を試みます...")
+    # 一括変換で同時に実行されても衝突しないよう出力ファイルごとに別名にする
+    unlocked_pdf = f"{os.path.splitext(output_docx)[0]}_unlocked_temp.pdf"
+    if unlock_pdf(input_pdf, unlocked_pdf):
+        print("\n制限解除したPDFで再変換...")
+        if convert_with_pdf2docx(unlocked_pdf, output_docx) or convert_with_pymupdf(
+            unlocked_pdf, output_docx, workers, safe_docx
+        ):
+            os.remove(unlocked_pdf)  # 一時ファイル削除
+            return True
+        os.remove(unlocked_pdf)
+
+    print("\n✗ 全ての変換方法が失敗しました")
+    return False
+
+
+def convert_pdf_job(input_pdf, output_docx, safe_docx=False):
+    """ワーカープロセスで変換し、(成功したか, ログ) を返す
+
+    並列実行したジョブの出力が混ざらないよう、ログは親プロセスでまとめて表示する
+    """
+    log = io.StringIO()
+    # pdf2docxの進捗はloggingでstderrに出るため、ルートロガーの出力先も差し替える
+    # （ハンドラーがあればpdf2docxのimport時のbasicConfigは何もしない）
+    handler = logging.StreamHandler(log)
+    handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers, root.level
+    root.handlers = [handler]
+    root.setLevel(logging.INFO)
+    try:
+        with redirect_stdout(log), redirect_stderr(log):
+            # ファイル単位で並列実行するのでページ単位では並列化しない
+            ok = convert_pdf(input_pdf, output_docx, workers=1, safe_docx=safe_docx)
+    finally:
+        root.handlers = saved_handlers
+        root.setLevel(saved_level)
+    return ok, log.getvalue()
+
+
+def convert_dir(input_dir, output_dir=None, workers=DEFAULT_WORKERS, safe_docx=False):
+    """ディレクトリ内のPDFを複数プロセスで並列に変換（すべて成功したらTrue）"""
+    pdfs = sorted(p for p in Path(input_dir).iterdir() if p.suffix.lower() == ".pdf")
+    if not pdfs:
+        print(f"エラー: PDFファイルが見つかりません: {input_dir}")
+        return False
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    print(f"\n=== PDF to Word 一括変換 ===")
+    print(f"入力: {input_dir}/ ({len(pdfs)} ファイル)")
+    print(f"出力: {output_dir or input_dir}/")
+    print(f"並列数: {min(workers, len(pdfs))}\n")
+
+    success_count = 0
+    with ProcessPoolExecutor(max_workers=min(workers, len(pdfs))) as executor:
+        futures = {
+            executor.submit(
+                convert_pdf_job,
+                str(pdf),
+                str(Path(output_dir or pdf.parent) / f"{pdf.stem}.docx"),
+                safe_docx,
+            ): pdf
+            for pdf in pdfs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                ok, log = future.result()
+            except Exception as e:
+                # ワーカーが異常終了した場合 (BrokenProcessPool) などもそのファイルの失敗として扱う
+                ok, log = False, f"✗ 変換中にエラー: {e!r}\n"
+            print(f"--- [{done}/{len(pdfs)}] {futures[future].name} ---")
+            print(log)
+            success_count += ok
+
+    print(f"\n=== 処理完了 ===")
+    print(f"成功: {success_count}/{len(pdfs)}")
+    return success_count == len(pdfs)
+
+
 def main():
-    if len(sys.argv) < 2:
-        print("使い方: python convert_pdf.py input.pdf [output.docx]")
+    # --safe-docx: Word文書をpython-docxのAPIだけで組み立てる（XML直接挿入で問題が出る場合用）
+    safe_docx = "--safe-docx" in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != "--safe-docx"]
+
+    if len(args) < 1:
+        print("使い方: python convert_pdf.py input.pdf [output.docx] [--safe-docx]")
+        print("        python convert_pdf.py input_dir/ [output_dir/] [--safe-docx]")
         sys.exit(1)
 
-    input_pdf = sys.argv[1]
+    input_pdf = args[0]
 
     if not os.path.exists(input_pdf):
         print(f"エラー: ファイルが見つかりません: {input_pdf}")
         sys.exit(1)
 
+    # ディレクトリの場合は中のPDFをまとめて変換
+    if os.path.isdir(input_pdf):
+        output_dir = args[1] if len(args) >= 2 else None
+        if not convert_dir(input_pdf, output_dir, safe_docx=safe_docx):
+            sys.exit(1)
+        return
+
     # 出力ファイル名を決定
-    if len(sys.argv) >= 3:
-        output_docx = sys.argv[2]
+    if len(args) >= 2:
+        output_docx = args[1]
     else:
         base_name = os.path.splitext(input_pdf)[0]
         output_docx = f"{base_name}.docx"
@@ -88,29 +282,8 @@ def main():
     print(f"入力: {input_pdf}")
     print(f"出力: {output_docx}\n")
 
-    # まずpdf2docxを試す（レイアウトが綺麗）
-    if convert_with_pdf2docx(input_pdf, output_docx):
-        return
-
-    # 失敗したらPyMuPDFを試す（制限に強い）
-    print("\n別の方法を試します...")
-    if convert_with_pymupdf(input_pdf, output_docx):
-        return
-
-    # それでも失敗したら制限解除を試みる
-    print("\nPDF制限解除を試みます...")
-    unlocked_pdf = "unlocked_temp.pdf"
-    if unlock_pdf(input_pdf, unlocked_pdf):
-        print("\n制限解除したPDFで再変換...")
-        if convert_with_pdf2docx(unlocked_pdf, output_docx) or convert_with_pymupdf(
-            unlocked_pdf, output_docx
-        ):
-            os.remove(unlocked_pdf)  # 一時ファイル削除
-            return
-        os.remove(unlocked_pdf)
-
-    print("\n✗ 全ての変換方法が失敗しました")
-    sys.exit(1)
+    if not convert_pdf(input_pdf, output_docx, safe_docx=safe_docx):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,36 @@
+from .core import (
+    CACHE_DIR,
+    IMAGE_FORMATS,
+    IMAGE_PLACEHOLDER,
+    MAX_ATTEMPTS,
+    OCR_PROMPT,
+    RateLimiter,
+    add_conversion_arguments,
+    build_ocr_body,
+    build_request_body,
+    cache_hasher,
+    cache_path_for,
+    convert_pdf_to_images,
+    convert_pdf_with_ocr,
+    count_pages,
+    encode_image,
+    get_api_key,
+    hash_image,
+    is_retryable_error,
+    markdown_to_docx,
+    non_negative_int,
+    ocr_all_pages,
+    ocr_with_openrouter,
+    positive_float,
+    positive_int,
+    post_ocr_request,
+    quality_int,
+    read_response,
+    read_stream,
+    render_pages,
+    retry_delay,
+    sleep_before_retry,
+    with_index,
+    write_cache,
+    write_output,
+)
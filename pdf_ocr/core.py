@@ -0,0 +1,1107 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import os
+import random
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import repeat
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+import aiohttp
+
+try:
+    import pybase64 as base64  # SIMD実装（未インストールなら標準ライブラリ）
+except ImportError:
+    import base64
+
+try:
+    import orjson as json  # 高速なJSON実装（未インストールなら標準ライブラリ）
+except ImportError:
+    import json
+
+# OCR用プロンプト
+OCR_PROMPT = """この画像からテキストを正確に抽出してください。
+
+要件:
+- レイアウト、表、箇条書きなどの構造を保持
+- 出力はマークダウン形式
+- 余計な説明は不要、テキストのみを出力
+- 日本語の場合は日本語で、英語の場合は英語で出力"""
+
+# ページ画像の形式ごとの拡張子とMIMEタイプ
+IMAGE_FORMATS = {
+    "jpeg": ("jpg", "image/jpeg"),
+    "png": ("png", "image/png"),
+}
+
+# ページ画像化の既定ワーカー数
+DEFAULT_WORKERS = min(os.cpu_count() or 1, 6)
+
+# リクエストJSON内で画像のdata URIに置き換える文字列
+IMAGE_PLACEHOLDER = "__PDF_OCR_IMAGE_DATA_URI__"
+
+# 画像を読み込む単位（3の倍数なのでチャンクごとのBase64をそのまま連結できる）
+ENCODE_CHUNK_SIZE = 57 * 1024
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# マークダウン解析用の正規表現
+HEADING_RE = re.compile(r"(#{1,4}) (.*)")
+NUMBERED_RE = re.compile(r"\d+\.\s+(.*)")
+BOLD_RE = re.compile(r"\*\*([^*]+)\*\*")
+
+# テキスト層の文字数がこれを超えるページはOCRしない
+MIN_TEXT_CHARS = 50
+
+# OCR結果のキャッシュ先
+CACHE_DIR = Path.home() / ".cache" / "pdf-ocr-llm"
+
+# リトライ設定
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+RETRY_MIN_WAIT = 1
+RETRY_MAX_WAIT = 30
+RETRY_AFTER_MAX_WAIT = 120  # Retry-Afterヘッダーに従う待機時間の上限
+
+
+@lru_cache(maxsize=8)
+def open_pdf(pdf_path):
+    """PDFを開く（同じプロセス内では開いた文書を使い回し、バッチごとに開き直さない）"""
+    import fitz  # PyMuPDF
+
+    return fitz.open(pdf_path)
+
+
+def render_pages(
+    pdf_path,
+    page_numbers,
+    dpi,
+    image_format,
+    jpeg_quality,
+    max_edge,
+    grayscale,
+    min_text_chars,
+):
+    """指定ページを ("text", テキスト) または ("image", 画像バイト列) に変換
+
+    ワーカープロセスで実行される。テキスト層にmin_text_chars文字より多い
+    テキストがあるページは描画せずにそのテキストを返す（0なら常に描画）。
+    長辺がmax_edgeピクセルを超えるページは縮小して描画する（0なら縮小しない）
+    grayscaleならグレースケールで描画する
+    """
+    import fitz  # PyMuPDF
+
+    # fitz.Documentはプロセス間で共有できないため各ワーカーで開く
+    pdf = open_pdf(pdf_path)
+    zoom = dpi / 72  # 72 DPI base
+    # アルファチャンネルはJPEGにできず容量も増えるため常に外す
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    pages = []
+    for page_num in page_numbers:
+        page = pdf[page_num]
+        # テキスト層があるページはOCR不要なので描画もしない
+        if min_text_chars:
+            text = page.get_text("text")
+            if len(text.strip()) > min_text_chars:
+                pages.append(("text", text))
+                continue
+
+        # 高解像度で変換（モデル側で縮小される分は最初から描画しない）
+        scale = zoom
+        if max_edge:
+            long_edge = max(page.rect.width, page.rect.height) * zoom
+            scale = zoom * min(1.0, max_edge / long_edge)
+        pix = page.get_pixmap(
+            matrix=fitz.Matrix(scale, scale), colorspace=colorspace, alpha=False
+        )
+        if image_format == "jpeg":
+            pages.append(("image", pix.tobytes("jpeg", jpg_quality=jpeg_quality)))
+        else:
+            pages.append(("image", pix.tobytes("png")))
+    return pages
+
+
+def chunk_pages(page_numbers, size):
+    """ページ番号をsizeページずつの連続した範囲に分割"""
+    return [page_numbers[i : i + size] for i in range(0, len(page_numbers), size)]
+
+
+def render_all_pages(
+    pdf_path,
+    page_numbers,
+    dpi,
+    image_format,
+    jpeg_quality,
+    max_edge,
+    grayscale,
+    min_text_chars,
+    workers,
+    executor=None,
+):
+    """指定ページを複数プロセスで並列に変換（結果はページ順）
+
+    executorを指定するとそのプロセスプールを使い、呼び出しごとにプロセスを起動しない
+    """
+    if workers <= 1 or len(page_numbers) <= 1:
+        return render_pages(
+            pdf_path,
+            page_numbers,
+            dpi,
+            image_format,
+            jpeg_quality,
+            max_edge,
+            grayscale,
+            min_text_chars,
+        )
+
+    chunks = chunk_pages(page_numbers, -(-len(page_numbers) // workers))  # 切り上げ
+    with (
+        nullcontext(executor)
+        if executor
+        else ProcessPoolExecutor(max_workers=len(chunks))
+    ) as executor:
+        results = executor.map(
+            render_pages,
+            repeat(pdf_path),
+            chunks,
+            repeat(dpi),
+            repeat(image_format),
+            repeat(jpeg_quality),
+            repeat(max_edge),
+            repeat(grayscale),
+            repeat(min_text_chars),
+        )
+        return [page for chunk in results for page in chunk]
+
+
+def count_pages(pdf_path):
+    """PDFのページ数を取得（読み込めなければNone）"""
+    try:
+        import fitz  # PyMuPDF
+
+        with fitz.open(pdf_path) as pdf:
+            return len(pdf)
+    except Exception as e:
+        print(f"PDF読み込みエラー: {e}")
+        return None
+
+
+def convert_pdf_to_images(
+    pdf_path,
+    page_numbers,
+    output_dir=None,
+    dpi=200,
+    image_format="jpeg",
+    jpeg_quality=85,
+    max_edge=1600,
+    grayscale=False,
+    min_text_chars=MIN_TEXT_CHARS,
+    workers=DEFAULT_WORKERS,
+    filename_format="page_{page}.{ext}",
+    executor=None,
+):
+    """指定ページを ("text", テキスト) / ("image", 画像バイト列) のリストに変換
+
+    テキスト層のないページだけを画像化し、output_dir指定時はその画像を保存する
+    executorを指定するとそのプロセスプールで描画する
+    """
+    try:
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        ext = IMAGE_FORMATS[image_format][0]
+
+        print(f"PDFを画像に変換中: {len(page_numbers)} ページ ({workers} プロセス)")
+        pages = render_all_pages(
+            pdf_path,
+            page_numbers,
+            dpi,
+            image_format,
+            jpeg_quality,
+            max_edge,
+            grayscale,
+            min_text_chars,
+            workers,
+            executor,
+        )
+
+        for page_num, (kind, data) in zip(page_numbers, pages):
+            if kind == "text":
+                print(f"  ページ {page_num + 1} テキスト層を使用 (OCR不要)")
+            elif output_dir:
+                image_path = os.path.join(
+                    output_dir, filename_format.format(page=page_num + 1, ext=ext)
+                )
+                with open(image_path, "wb") as f:
+                    f.write(data)
+                print(f"  ページ {page_num + 1} 変換完了 -> {image_path}")
+            else:
+                print(f"  ページ {page_num + 1} 変換完了")
+
+        return pages
+    except Exception as e:
+        print(f"PDF変換エラー: {e}")
+        return None
+
+
+class RateLimiter:
+    """リクエスト間隔を 1/rps 秒以上に保つレートリミッター"""
+
+    def __init__(self, rps):
+        self.interval = 1.0 / rps
+        self.last_call = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            await asyncio.sleep(max(0, self.interval - (now - self.last_call)))
+            self.last_call = time.monotonic()
+
+
+def encode_image(image_file, mime_type, *hashers):
+    """画像をチャンクごとにhashersへ入力しながらBase64のdata URIに変換（bytearrayで返す）
+
+    生の画像データ全体をメモリに保持せず、出力先もサイズから最終的な長さで確保して
+    拡張によるコピーを起こさない
+    """
+    size = image_file.seek(0, os.SEEK_END)
+    image_file.seek(0)
+    prefix = f"data:{mime_type};base64,".encode()
+    data_uri = bytearray(len(prefix) + 4 * ((size + 2) // 3))
+    data_uri[: len(prefix)] = prefix
+    pos = len(prefix)
+    while chunk := image_file.read(ENCODE_CHUNK_SIZE):
+        for hasher in hashers:
+            hasher.update(chunk)
+        encoded = base64.b64encode(chunk)
+        data_uri[pos : pos + len(encoded)] = encoded
+        pos += len(encoded)
+    del data_uri[pos:]  # 読み込み中にファイルが縮んだ場合
+    return data_uri
+
+
+def hash_image(image_file, *hashers):
+    """画像をチャンクごとにhashersへ入力（Base64エンコードしない場合用）"""
+    while chunk := image_file.read(ENCODE_CHUNK_SIZE):
+        for hasher in hashers:
+            hasher.update(chunk)
+
+
+def build_request_body(payload, data_uri):
+    """画像部分をプレースホルダーにしてシリアライズし、data URIのbytesを直接埋め込む
+
+    数MBのBase64をstrにデコードしてJSONエンコーダーに通す分のコピーを省く
+    """
+    body = json.dumps(payload)
+    if isinstance(body, str):  # 標準ライブラリのjsonの場合
+        body = body.encode()
+    return body.replace(IMAGE_PLACEHOLDER.encode(), data_uri, 1)
+
+
+def is_retryable_error(status, error_msg):
+    """レート制限・一時的なサーバーエラーならTrue
+
+    ストリーミング中のエラーはHTTP 200のまま届くため、エラー本文にcodeがあればそれで判定する
+    """
+    code = error_msg.get("code") if isinstance(error_msg, dict) else None
+    if code is not None:
+        try:
+            status = int(code)
+        except (TypeError, ValueError):
+            pass
+    if status in RETRY_STATUSES:
+        return True
+    detail = str(error_msg).lower()
+    return "rate limit" in detail or "quota" in detail
+
+
+def retry_delay(attempt, retry_after=None):
+    """リトライまでの待機秒数（Retry-Afterヘッダーを優先、ただし上限あり）"""
+    if retry_after:
+        try:
+            return min(RETRY_AFTER_MAX_WAIT, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return min(RETRY_MAX_WAIT, RETRY_MIN_WAIT * 2 ** (attempt - 1))
+
+
+async def sleep_before_retry(attempt, retry_after=None, name=None):
+    """リトライ前に待機（同時に失敗したリクエストが一斉に再送しないようジッターを加える）"""
+    delay = retry_delay(attempt, retry_after) + random.uniform(0, 0.5)
+    print(
+        f"  {name + ': ' if name else ''}{delay:.1f}秒後にリトライ"
+        f" ({attempt}/{MAX_ATTEMPTS - 1})"
+    )
+    await asyncio.sleep(delay)
+
+
+def cache_hasher(model, prompt=OCR_PROMPT):
+    """モデル・プロンプトを入力済みのキャッシュキー用ハッシュ（続けて画像を入力する）"""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(model.encode())
+    h.update(prompt.encode())
+    return h
+
+
+def cache_path_for(cache_dir, hasher):
+    """画像まで入力したハッシュからキャッシュファイルのパスを生成"""
+    return Path(cache_dir) / f"{hasher.hexdigest()}.md"
+
+
+def write_cache(cache_path, text):
+    """一時ファイル経由でキャッシュをアトミックに書き込み"""
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(text, encoding="utf-8")
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"キャッシュ書き込みエラー: {e}")
+
+
+async def read_stream(response, out=None):
+    """SSEで届くdeltaを連結して (テキスト, エラー) を返す
+
+    outを指定すると届いたdeltaから順にそのファイルへ書き出す
+    """
+    parts = []
+    done = False
+    async for line in response.content:
+        line = line.strip()
+        # ": OPENROUTER PROCESSING" などのコメント行は無視
+        if not line.startswith(b"data: "):
+            continue
+        data = line[6:]
+        if data == b"[DONE]":
+            done = True
+            break
+        chunk = json.loads(data)
+        if "error" in chunk:
+            return None, chunk["error"]
+        if chunk.get("choices"):
+            delta = chunk["choices"][0].get("delta", {}).get("content") or ""
+            parts.append(delta)
+            if out and delta:
+                out.write(delta)
+                out.flush()
+    if not done:
+        # [DONE]の前に切れたストリームは途中までの結果なので失敗として扱う（リトライ対象）
+        raise aiohttp.ClientPayloadError("ストリームが[DONE]の前に終了しました")
+    return "".join(parts), None
+
+
+def write_output(output_file, text):
+    """OCR結果をテキストファイルに保存"""
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+async def read_response(response, output_file=None):
+    """OCRのレスポンスを (テキスト, エラー) として読み込み、output_fileにも保存
+
+    SSEの場合はdeltaが届くたびに書き出す（失敗した場合はファイルを残さない）
+    """
+    if response.content_type != "text/event-stream":
+        # ストリーミングに対応していない場合は通常のJSONレスポンス
+        result = json.loads(await response.read())
+        if "error" in result:
+            return None, result["error"]
+        text = result["choices"][0]["message"]["content"]
+        if output_file and text:
+            write_output(output_file, text)
+        return text, None
+
+    if output_file is None:
+        return await read_stream(response)
+
+    part_file = f"{output_file}.part"
+    try:
+        with open(part_file, "w", encoding="utf-8") as out:
+            text, error_msg = await read_stream(response, out)
+        if error_msg is None and text:
+            os.replace(part_file, output_file)
+        return text, error_msg
+    finally:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+
+
+def build_ocr_body(image_url, model, prompt=OCR_PROMPT):
+    """OCRリクエストのボディ (JSON) を組み立てる
+
+    image_urlはdata URIのbytes（Base64をstrに戻さず直接埋め込む）またはURL文字列
+    """
+    payload = {
+        "model": model,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": (
+                                image_url
+                                if isinstance(image_url, str)
+                                else IMAGE_PLACEHOLDER
+                            )
+                        },
+                    },
+                ],
+            }
+        ],
+        "max_tokens": 4000,
+        "temperature": 0.1,
+        "stream": True,
+    }
+    if isinstance(image_url, str):
+        return json.dumps(payload)
+    return build_request_body(payload, image_url)
+
+
+async def post_ocr_request(
+    session,
+    request_body,
+    api_key,
+    limiter,
+    title="PDF to Word Converter",
+    cache_path=None,
+    output_file=None,
+    name=None,
+):
+    """build_ocr_bodyで組み立てたリクエストを送信してOCR結果を返す（失敗したらNone）
+
+    同時実行数の制限は呼び出し側で行う（リクエストボディの準備から完了まで枠を保持する）
+    429/5xxはジッター付き指数バックオフでリトライする
+    cache_pathを指定すると成功した結果をキャッシュに保存し、output_fileを指定すると
+    結果をストリーミングで受信しながらそのファイルに保存する
+    nameは並列実行中のどの画像のメッセージか分かるようにメッセージに付ける名前
+    """
+    label = f" ({name})" if name else ""
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "HTTP-Referer": "https://github.com/pdf-converter",
+        "X-Title": title,
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+    }
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        retry_after = None
+        try:
+            # リクエスト間隔を制限してOpenRouter API呼び出し
+            await limiter.acquire()
+            async with session.post(
+                OPENROUTER_URL, headers=headers, data=request_body
+            ) as response:
+                if response.status == 200:
+                    # 生成されたトークンから順に受信（output_fileにも書き出す）
+                    text, error_msg = await read_response(response, output_file)
+                    if error_msg is None:
+                        if cache_path and text:
+                            write_cache(cache_path, text)
+                        return text
+                else:
+                    try:
+                        body = json.loads(await response.read())
+                        error_msg = body.get("error", {})
+                    except ValueError:
+                        error_msg = await response.text()
+                    retry_after = response.headers.get("Retry-After")
+
+            print(f"OpenRouter APIエラー{label}: {response.status}")
+            print(f"詳細: {error_msg}")
+            if not is_retryable_error(response.status, error_msg):
+                return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"リクエストエラー{label}: {e}")
+
+        if attempt < MAX_ATTEMPTS:
+            await sleep_before_retry(attempt, retry_after, name)
+
+    return None
+
+
+async def ocr_with_openrouter(
+    session,
+    image_bytes,
+    mime_type,
+    model,
+    api_key,
+    semaphore,
+    limiter,
+    cache_dir=None,
+    name=None,
+):
+    """OpenRouterを使ってOCR実行（429/5xxは指数バックオフでリトライ）
+
+    cache_dirを指定すると同じ画像・モデルの結果をキャッシュから返す
+    Base64のリクエストボディは同時実行数の枠を取ってから作るので、メモリ上に
+    あるボディは同時実行数分だけになる
+    """
+    try:
+        async with semaphore:
+            # キャッシュキーのハッシュ計算とBase64エンコードを1回の読み込みで行う
+            # （数MBの処理で受信中の他のストリームを止めないようスレッドで実行）
+            hasher = cache_hasher(model)
+            data_uri = await asyncio.to_thread(
+                encode_image, io.BytesIO(image_bytes), mime_type, hasher
+            )
+
+            cache_path = None
+            if cache_dir:
+                cache_path = cache_path_for(cache_dir, hasher)
+                if cache_path.exists():
+                    return cache_path.read_text(encoding="utf-8")
+
+            # 数MBのBase64を含むのでシリアライズはリトライ前に一度だけ行う
+            request_body = build_ocr_body(data_uri, model)
+            del data_uri
+            return await post_ocr_request(
+                session,
+                request_body,
+                api_key,
+                limiter,
+                cache_path=cache_path,
+                name=name,
+            )
+
+    except Exception as e:
+        print(f"OCRエラー{f' ({name})' if name else ''}: {e}")
+        return None
+
+
+def write_partial_page(partial_file, page, text):
+    """途中で失敗しても完了済みページを残せるよう1ページずつ書き出す"""
+    partial_file.write(f"<!-- page {page} -->\n{text}\n\n")
+    partial_file.flush()
+
+
+async def with_index(index, coro):
+    """コルーチンの結果をインデックス付きで返す"""
+    return index, await coro
+
+
+async def ocr_all_pages(
+    session,
+    semaphore,
+    limiter,
+    images,
+    page_numbers,
+    mime_type,
+    model,
+    api_key,
+    partial_file,
+    cache_dir=CACHE_DIR,
+):
+    """ページのOCRを並列実行し、完了したページから順次partial_fileに書き出す
+
+    session・semaphore・limiterは全バッチで共有する
+    戻り値はページ順のテキストのリスト（失敗したページはNone）
+    """
+    texts = [None] * len(images)
+    tasks = [
+        with_index(
+            index,
+            ocr_with_openrouter(
+                session,
+                image_bytes,
+                mime_type,
+                model,
+                api_key,
+                semaphore,
+                limiter,
+                cache_dir,
+                f"ページ {page_numbers[index] + 1}",
+            ),
+        )
+        for index, image_bytes in enumerate(images)
+    ]
+    for done, future in enumerate(asyncio.as_completed(tasks), 1):
+        index, text = await future
+        texts[index] = text
+        page = page_numbers[index] + 1
+        if text:
+            write_partial_page(partial_file, page, text)
+            print(f"  [{done}/{len(images)}] ページ {page} 完了")
+        else:
+            print(f"  [{done}/{len(images)}] ページ {page} 失敗")
+    return texts
+
+
+async def ocr_pdf_batches(
+    input_pdf,
+    num_pages,
+    model,
+    api_key,
+    args,
+    partial_file,
+    image_dir,
+    filename_format,
+    timeout,
+    executor,
+):
+    """PDFをバッチごとに画像化・OCRし、(ページ順のテキストのリスト, 保存した画像数) を返す
+
+    描画に失敗した場合はNoneを返す。
+    HTTPS接続とプロセスプールは全バッチで使い回し、次のバッチの描画は
+    現在のバッチのOCRと並行して行う（メモリ上の画像は最大2バッチ分）
+    """
+    loop = asyncio.get_running_loop()
+    mime_type = IMAGE_FORMATS[args.image_format][1]
+    batches = chunk_pages(range(num_pages), args.batch_size)
+
+    def render(batch):
+        return convert_pdf_to_images(
+            input_pdf,
+            batch,
+            output_dir=image_dir,
+            dpi=args.dpi,
+            image_format=args.image_format,
+            jpeg_quality=args.jpeg_quality,
+            max_edge=args.max_image_edge,
+            grayscale=args.grayscale,
+            min_text_chars=args.min_text_chars,
+            workers=args.workers,
+            filename_format=filename_format,
+            executor=executor,
+        )
+
+    semaphore = asyncio.Semaphore(args.max_concurrent)
+    limiter = RateLimiter(args.rps)
+    texts = []
+    saved_images = 0
+    # 同時実行数ぶんのHTTPS接続をキープアライブで使い回す
+    connector = aiohttp.TCPConnector(limit=args.max_concurrent, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as session:
+        # 描画はプロセスプールを待つだけなのでスレッドから投げてイベントループを止めない
+        next_pages = loop.run_in_executor(None, render, batches[0])
+        for n, batch in enumerate(batches):
+            pages = await next_pages
+            if not pages:
+                return None
+            print(f"\n--- ページ {batch[0] + 1}-{batch[-1] + 1}/{num_pages} ---")
+            if n + 1 < len(batches):
+                next_pages = loop.run_in_executor(None, render, batches[n + 1])
+            if image_dir:
+                saved_images += sum(kind == "image" for kind, _ in pages)
+
+            # テキスト層のあるページはそのまま使い、残りだけOCRする
+            batch_texts = [data if kind == "text" else None for kind, data in pages]
+            ocr_indices = []
+            for i, (kind, data) in enumerate(pages):
+                if kind == "text":
+                    write_partial_page(partial_file, batch[i] + 1, data)
+                else:
+                    ocr_indices.append(i)
+
+            if ocr_indices:
+                ocr_texts = await ocr_all_pages(
+                    session,
+                    semaphore,
+                    limiter,
+                    [pages[i][1] for i in ocr_indices],
+                    [batch[i] for i in ocr_indices],
+                    mime_type,
+                    model,
+                    api_key,
+                    partial_file,
+                    cache_dir=None if args.no_cache else CACHE_DIR,
+                )
+                for i, text in zip(ocr_indices, ocr_texts):
+                    batch_texts[i] = text
+
+            texts += batch_texts
+            # OCRが終わったバッチの画像は解放してメモリ使用量を抑える
+            del pages
+    return texts, saved_images
+
+
+def install_event_loop():
+    """Linuxではuvloopを使用（未インストールなら標準のイベントループ）"""
+    if not sys.platform.startswith("linux"):
+        return
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        pass
+
+
+def add_code_line(doc, line):
+    """コードブロック内の行を等幅フォントで追加"""
+    from docx.shared import Pt
+
+    p = doc.add_paragraph(line)
+    p.style = "Normal"
+    run = p.runs[0]
+    run.font.name = "Courier New"
+    run.font.size = Pt(9)
+
+
+def cell_xml(width, text):
+    """テーブルセル (w:tc) のXML文字列"""
+    run = f'<w:r><w:t xml:space="preserve">{escape(text)}</w:t></w:r>' if text else ""
+    return (
+        f'<w:tc><w:tcPr><w:tcW w:w="{width}" w:type="dxa"/></w:tcPr>'
+        f"<w:p>{run}</w:p></w:tc>"
+    )
+
+
+def add_table(doc, table_data):
+    """蓄積したテーブル行をWord tableとして追加
+
+    python-docxのcellアクセスは1回ごとに行のXMLを走査して遅いため、
+    行 (w:tr) のXMLをまとめて組み立てて一度に追加する
+    """
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls, qn
+
+    cols = len(table_data[0])
+    table = doc.add_table(rows=0, cols=cols)
+    table.style = "Table Grid"
+    widths = [col.get(qn("w:w")) for col in table._tbl.tblGrid.iterchildren()]
+
+    rows = []
+    for row_data in table_data:
+        # 列数が揃っていない行は1行目の列数に合わせる
+        cells = (row_data + [""] * cols)[:cols]
+        rows.append(
+            "<w:tr>"
+            + "".join(cell_xml(w, text) for w, text in zip(widths, cells))
+            + "</w:tr>"
+        )
+    tbl = parse_xml(f'<w:tbl {nsdecls("w")}>{"".join(rows)}</w:tbl>')
+    table._tbl.extend(list(tbl))
+
+
+def add_heading_line(doc, line, stripped):
+    """見出し (# 〜 ####)"""
+    m = HEADING_RE.match(line)
+    if m:
+        doc.add_heading(m.group(2), level=len(m.group(1)))
+        return True
+    return False
+
+
+def add_bullet_line(doc, line, stripped):
+    """箇条書き (- / *)、"- " だけの行は通常のテキスト扱い"""
+    item = stripped[2:].rstrip()
+    if stripped[1:2] == " " and item:
+        doc.add_paragraph(item, style="List Bullet")
+        return True
+    return False
+
+
+def add_numbered_line(doc, line, stripped):
+    """番号付きリスト (1. )"""
+    m = NUMBERED_RE.match(stripped)
+    if m:
+        doc.add_paragraph(m.group(1).rstrip(), style="List Number")
+        return True
+    return False
+
+
+def add_text_line(doc, line, stripped):
+    """太字を含む行・通常のテキスト・空行"""
+    if "**" in line:
+        p = doc.add_paragraph()
+        pos = 0
+        for m in BOLD_RE.finditer(line):
+            if m.start() > pos:
+                p.add_run(line[pos : m.start()])
+            p.add_run(m.group(1)).bold = True
+            pos = m.end()
+        if pos < len(line):
+            p.add_run(line[pos:])
+    elif stripped:
+        doc.add_paragraph(line)
+    else:
+        # 空行
+        doc.add_paragraph()
+
+
+# 行頭の文字 -> 行の処理 (処理できなければFalseを返し通常のテキスト扱い)
+# 各処理には元の行と、行頭の空白だけを除いた行が渡される
+LINE_HANDLERS = {
+    "#": add_heading_line,
+    "-": add_bullet_line,
+    "*": add_bullet_line,
+}
+
+
+def markdown_to_docx(markdown_text, output_path):
+    """マークダウンをWordドキュメントに変換"""
+    try:
+        from docx import Document
+
+        doc = Document()
+
+        in_code_block = False
+        table_data = []
+
+        for line in markdown_text.split("\n"):
+            # 行頭の空白を一度だけ読み飛ばし、以降はその結果と先頭文字で判定
+            stripped = line.lstrip()
+            first = stripped[:1]
+
+            # コードブロックの処理
+            if first == "`" and stripped.startswith("```"):
+                in_code_block = not in_code_block
+                continue
+
+            if in_code_block:
+                add_code_line(doc, line)
+                continue
+
+            # テーブルの処理
+            if first == "|":
+                cells = [cell.strip() for cell in stripped.split("|")[1:-1]]
+                if cells:
+                    if not table_data:
+                        table_data = [cells]
+                    elif all(c.replace("-", "").strip() == "" for c in cells):
+                        # テーブルヘッダー区切り行をスキップ
+                        continue
+                    else:
+                        table_data.append(cells)
+                continue
+            elif table_data:
+                # テーブル終了、Word tableとして追加
+                add_table(doc, table_data)
+                table_data = []
+
+            # 行頭の文字で見出し・箇条書き・番号付きリストを振り分け
+            handler = LINE_HANDLERS.get(first)
+            if handler is None and first.isdigit():
+                handler = add_numbered_line
+            if handler is None or not handler(doc, line, stripped):
+                add_text_line(doc, line, stripped)
+
+        # 最後にテーブルが残っている場合
+        if table_data:
+            add_table(doc, table_data)
+
+        doc.save(output_path)
+        return True
+    except Exception as e:
+        print(f"Word変換エラー: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return False
+
+
+def positive_int(value):
+    """argparse用: 1以上の整数"""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"1以上の整数を指定してください: {value}")
+    return number
+
+
+def non_negative_int(value):
+    """argparse用: 0以上の整数"""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"0以上の整数を指定してください: {value}")
+    return number
+
+
+def quality_int(value):
+    """argparse用: 1-100の整数 (JPEG画質)"""
+    number = int(value)
+    if not 1 <= number <= 100:
+        raise argparse.ArgumentTypeError(f"1-100の整数を指定してください: {value}")
+    return number
+
+
+def positive_float(value):
+    """argparse用: 0より大きい数値"""
+    number = float(value)
+    if not number > 0:  # NaNも弾く
+        raise argparse.ArgumentTypeError(f"0より大きい数値を指定してください: {value}")
+    return number
+
+
+def add_conversion_arguments(parser, min_text_chars=MIN_TEXT_CHARS):
+    """画像変換・OCRに共通のコマンドライン引数を追加
+
+    min_text_charsは--min-text-charsの既定値（0なら既定でテキスト層を使わない）
+    """
+    parser.add_argument(
+        "--dpi",
+        type=positive_int,
+        default=200,
+        help="画像変換時のDPI (デフォルト: 200)。"
+        "画像の長辺は--max-image-edgeで制限されるため、既定の1600ではA4のページで"
+        "約140を超えるDPIは効果がない（保存するページ画像も同様）",
+    )
+    parser.add_argument(
+        "--image-format",
+        default="jpeg",
+        choices=list(IMAGE_FORMATS.keys()),
+        help="OCRに送る画像形式 (デフォルト: jpeg)",
+    )
+    parser.add_argument(
+        "--jpeg-quality",
+        type=quality_int,
+        default=85,
+        help="JPEG画質 1-100 (デフォルト: 85)",
+    )
+    parser.add_argument(
+        "--max-image-edge",
+        type=non_negative_int,
+        default=1600,
+        help="OCRに送る画像の長辺の最大ピクセル数、0で縮小しない (デフォルト: 1600)",
+    )
+    parser.add_argument(
+        "--grayscale",
+        action="store_true",
+        help="グレースケールで画像化 (文字だけの文書向け、画像サイズを削減)",
+    )
+    parser.add_argument(
+        "--min-text-chars",
+        type=int,
+        default=min_text_chars,
+        help="テキスト層の文字数がこれを超えるページはOCRせずそのまま使う、"
+        f"0で常にOCR (デフォルト: {min_text_chars})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        default=DEFAULT_WORKERS,
+        help=f"画像変換の並列プロセス数 (デフォルト: {DEFAULT_WORKERS})",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=positive_int,
+        default=10,
+        help="一度に画像化・OCRするページ数 (デフォルト: 10)",
+    )
+    parser.add_argument(
+        "--max-concurrent",
+        type=positive_int,
+        default=5,
+        help="OCRの最大同時リクエスト数 (デフォルト: 5)",
+    )
+    parser.add_argument(
+        "--rps",
+        type=positive_float,
+        default=2.0,
+        help="1秒あたりの最大リクエスト数 (デフォルト: 2)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"OCR結果のキャッシュを使わない (キャッシュ先: {CACHE_DIR})",
+    )
+
+
+def get_api_key(args):
+    """引数または環境変数からAPIキーを取得（なければ終了）"""
+    api_key = args.api_key or os.environ.get("OPENROUTER_API_KEY")
+    if not api_key:
+        script = os.path.basename(sys.argv[0])
+        print("エラー: OPENROUTER_API_KEYが設定されていません")
+        print("\n以下のいずれかの方法で設定してください:")
+        print("1. export OPENROUTER_API_KEY='your-api-key'")
+        print(f"2. python {script} input.pdf --api-key your-api-key")
+        sys.exit(1)
+    return api_key
+
+
+def convert_pdf_with_ocr(
+    input_pdf,
+    output_docx,
+    model,
+    api_key,
+    args,
+    image_dir=None,
+    filename_format="page_{page}.{ext}",
+    timeout=180,
+):
+    """PDFをバッチごとに画像化・OCRしてWord文書に変換し、保存したページ画像の数を返す
+
+    argsはadd_conversion_argumentsで追加した引数を含むこと
+    テキスト層を使ったページは画像化しないのでimage_dirにも保存されない
+    """
+    # Step 1: PDFをバッチごとに画像に変換してOCR
+    num_pages = count_pages(input_pdf)
+    if not num_pages:
+        print("✗ PDF変換失敗")
+        sys.exit(1)
+
+    partial_md = f"{os.path.splitext(output_docx)[0]}.partial.md"
+
+    print(f"Step 1: 画像変換とOCRを {args.batch_size} ページずつ実行中...")
+    print(f"  途中結果: {partial_md}")
+    install_event_loop()
+    # プロセスプールはバッチごとに作り直さず、実行全体で1つだけ起動する
+    with (
+        ProcessPoolExecutor(max_workers=args.workers)
+        if args.workers > 1
+        else nullcontext()
+    ) as executor, open(partial_md, "w", encoding="utf-8") as partial_file:
+        result = asyncio.run(
+            ocr_pdf_batches(
+                input_pdf,
+                num_pages,
+                model,
+                api_key,
+                args,
+                partial_file,
+                image_dir,
+                filename_format,
+                timeout,
+                executor,
+            )
+        )
+    if result is None:
+        print("✗ PDF変換失敗")
+        sys.exit(1)
+    texts, saved_images = result
+
+    all_text = []
+    for i, text in enumerate(texts, 1):
+        if text:
+            all_text.append(text)
+            if i < num_pages:
+                all_text.append("\n\n---\n\n")  # ページ区切り
+        else:
+            print(f"  ⚠ ページ {i} のOCR失敗")
+
+    if not all_text:
+        print("\n✗ 全ページのOCR失敗")
+        os.remove(partial_md)
+        sys.exit(1)
+
+    # Step 2: Wordドキュメントに変換
+    print("\nStep 2: Word文書に変換中...")
+    combined_text = "".join(all_text)
+
+    if markdown_to_docx(combined_text, output_docx):
+        print(f"\n✓ 変換成功: {output_docx}")
+    else:
+        print("\n⚠ Word変換に失敗しました")
+        # マークダウンファイルとして保存
+        md_output = output_docx.replace(".docx", ".md")
+        with open(md_output, "w", encoding="utf-8") as f:
+            f.write(combined_text)
+        print(f"  マークダウンとして保存: {md_output}")
+
+    # 最終出力ができたので途中結果は不要
+    os.remove(partial_md)
+
+    return saved_images